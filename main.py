@@ -1,17 +1,32 @@
 import os
+import re
+import sys
+import io
+import csv
+import time
+import collections
+import asyncio
+import functools
 import logging
-import psycopg2
-from urllib.parse import urlparse
+import asyncpg
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     ConversationHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
-from telegram.constants import ParseMode
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
+
+try:
+    import uvloop
+except ImportError:  # optional; falls back to the default asyncio loop
+    uvloop = None
 
 # --- Logging Configuration ---
 logging.basicConfig(
@@ -27,6 +42,17 @@ try:
 except KeyError as e:
     logger.error(f"FATAL: Environment variable {e} not set. Exiting.")
     exit()
+# Connections held open while idle; set to 0 for low-traffic bots so none are pinned
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "10"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "50"))
+# Set to 0 behind PgBouncer in transaction mode, which cannot keep prepared statements
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", "1024"))
+# Optional: when set, updates are pushed to this public HTTPS URL instead of being polled
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# Parallel HTTPS connections Telegram may open to deliver updates (Bot API default 40, max 100)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "100"))
 
 # --- Conversation States ---
 (
@@ -34,6 +60,7 @@ except KeyError as e:
     ADMIN_MENU, 
     ADMIN_ADD_USER, 
     ADMIN_REMOVE_USER,
+    ADMIN_IMPORT_ACCOUNTS,
     VIEW_CHOOSE_PERSON, 
     VIEW_CHOOSE_ACCOUNT,
     EDIT_MENU,
@@ -59,13 +86,37 @@ except KeyError as e:
     CHANGE_CHOOSE_FIELD, 
     CHANGE_PROMPT_FIELD_VALUE, 
     CHANGE_SAVE_FIELD_VALUE,
-) = range(29)
+) = range(30)
 
 # --- Keyboard Buttons & Mappings ---
 HOME_BUTTON = "صفحه اصلی 🏠"
 BACK_BUTTON = "بازگشت 🔙"
 SKIP_BUTTON = "رد شدن ⏭️"
 
+HOME_FILTER = filters.Regex(f"^{re.escape(HOME_BUTTON)}$")
+BACK_FILTER = filters.Regex(f"^{re.escape(BACK_BUTTON)}$")
+# Free-text input for a state; navigation buttons are left to their own handlers
+TEXT_INPUT = filters.TEXT & ~filters.COMMAND & ~HOME_FILTER & ~BACK_FILTER
+CONFIRM_DELETE_FILTER = filters.Regex(re.compile("^بله، حذف کن ✅$"))
+CANCEL_DELETE_FILTER = filters.Regex(re.compile("^نه، لغو کن ❌$"))
+# Matches the "<name> (<telegram_id>)" buttons of the remove-user keyboard
+USER_BUTTON_RE = re.compile(r"\((\d+)\)$")
+
+# Main menu keyboards; only the admin sees the admin entry
+MAIN_MENU_USER_MARKUP = ReplyKeyboardMarkup([["مشاهده اطلاعات 📄"], ["ویرایش ✏️"]], resize_keyboard=True)
+MAIN_MENU_ADMIN_MARKUP = ReplyKeyboardMarkup([["مشاهده اطلاعات 📄"], ["ویرایش ✏️", "ادمین 🛠️"]], resize_keyboard=True)
+
+# Static keyboards, built once instead of on every message
+ADMIN_MENU_MARKUP = ReplyKeyboardMarkup([["مشاهده کاربران مجاز 👁️"], ["افزودن کاربر ➕", "حذف کاربر ➖"], ["ورود حساب‌ها از فایل 📥"], [HOME_BUTTON]], resize_keyboard=True)
+EDIT_MENU_MARKUP = ReplyKeyboardMarkup([["اضافه کردن ➕"], ["تغییر دادن 📝", "حذف کردن 🗑️"], [HOME_BUTTON]], resize_keyboard=True)
+BACK_MARKUP = ReplyKeyboardMarkup([[BACK_BUTTON]], resize_keyboard=True)
+NAV_MARKUP = ReplyKeyboardMarkup([[BACK_BUTTON, HOME_BUTTON]], resize_keyboard=True)
+SKIP_NAV_MARKUP = ReplyKeyboardMarkup([[SKIP_BUTTON], [BACK_BUTTON, HOME_BUTTON]], resize_keyboard=True)
+ADD_PERSON_TYPE_MARKUP = ReplyKeyboardMarkup([["شخص جدید 👤", "شخص موجود 👥"], [BACK_BUTTON, HOME_BUTTON]], resize_keyboard=True)
+DELETE_TYPE_MARKUP = ReplyKeyboardMarkup([["حذف شخص 👤", "حذف حساب 💳"], [BACK_BUTTON, HOME_BUTTON]], resize_keyboard=True)
+CONFIRM_DELETE_MARKUP = ReplyKeyboardMarkup([["بله، حذف کن ✅", "نه، لغو کن ❌"], [HOME_BUTTON]], resize_keyboard=True)
+CHANGE_TARGET_MARKUP = ReplyKeyboardMarkup([["تغییر نام شخص 👤", "ویرایش یک حساب 💳"], [BACK_BUTTON, HOME_BUTTON]], resize_keyboard=True)
+
 # Maps user-facing field names to database columns for the change flow
 FIELD_TO_COLUMN_MAP = {
     "نام بانک 🏦": "bank_name",
@@ -74,136 +125,317 @@ FIELD_TO_COLUMN_MAP = {
     "شماره شبا 🌐": "shaba_number",
     "عکس کارت 🖼️": "card_photo_id",
 }
+CHANGE_FIELD_MARKUP = ReplyKeyboardMarkup(
+    [list(FIELD_TO_COLUMN_MAP)[i:i + 2] for i in range(0, len(FIELD_TO_COLUMN_MAP), 2)] + [[BACK_BUTTON, HOME_BUTTON]],
+    resize_keyboard=True,
+)
 
 # --- Database Functions ---
-def get_db_connection():
-    """Establishes a connection to the PostgreSQL database."""
-    try:
-        result = urlparse(DATABASE_URL)
-        conn = psycopg2.connect(
-            dbname=result.path[1:],
-            user=result.username,
-            password=result.password,
-            host=result.hostname,
-            port=result.port
-        )
-        return conn
-    except (psycopg2.OperationalError, ValueError) as e:
-        logger.error(f"Could not connect to database: {e}")
-        return None
+async def create_db_pool() -> asyncpg.Pool:
+    """Creates the shared PostgreSQL connection pool."""
+    return await asyncpg.create_pool(
+        dsn=DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=300,
+        command_timeout=60,
+        # asyncpg prepares each query once per connection and reuses the plan
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+    )
 
-def setup_database():
+SCHEMA_VERSION = 2  # bump whenever the DDL in setup_database changes
+
+async def setup_database(pool: asyncpg.Pool):
     """Initializes database tables if they don't exist."""
-    conn = get_db_connection()
-    if not conn: return
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    telegram_id BIGINT PRIMARY KEY,
-                    first_name TEXT NOT NULL
-                );
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS persons (
-                    id SERIAL PRIMARY KEY,
-                    name TEXT NOT NULL UNIQUE
-                );
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS accounts (
-                    id SERIAL PRIMARY KEY,
-                    person_id INTEGER REFERENCES persons(id) ON DELETE CASCADE,
-                    bank_name TEXT,
-                    account_number TEXT,
-                    card_number TEXT,
-                    shaba_number TEXT,
-                    card_photo_id TEXT
-                );
-            """)
-            cur.execute(
-                "INSERT INTO users (telegram_id, first_name) VALUES (%s, %s) ON CONFLICT (telegram_id) DO NOTHING;",
-                (ADMIN_TELEGRAM_ID, 'Admin')
+        async with pool.acquire() as conn:
+            try:
+                current = await conn.fetchval("SELECT max(v) FROM schema_version;")
+            except asyncpg.UndefinedTableError:
+                current = None
+            # Restarts against an up-to-date schema skip the DDL and its locks entirely
+            if current is None or current < SCHEMA_VERSION:
+                async with conn.transaction():
+                    # No arguments, so asyncpg sends the whole batch in one round-trip
+                    await conn.execute("""
+                        CREATE TABLE IF NOT EXISTS users (
+                            telegram_id BIGINT PRIMARY KEY,
+                            first_name TEXT NOT NULL
+                        );
+                        CREATE TABLE IF NOT EXISTS persons (
+                            id SERIAL PRIMARY KEY,
+                            name TEXT NOT NULL UNIQUE
+                        );
+                        CREATE TABLE IF NOT EXISTS accounts (
+                            id SERIAL PRIMARY KEY,
+                            person_id INTEGER REFERENCES persons(id) ON DELETE CASCADE,
+                            bank_name TEXT,
+                            account_number TEXT,
+                            card_number TEXT,
+                            shaba_number TEXT,
+                            card_photo_id TEXT
+                        );
+                        CREATE INDEX IF NOT EXISTS idx_accounts_person
+                            ON accounts (person_id, id) INCLUDE (bank_name, card_number);
+                        CREATE INDEX IF NOT EXISTS idx_users_name
+                            ON users (first_name, telegram_id);
+                        CREATE TABLE IF NOT EXISTS schema_version (
+                            v INTEGER PRIMARY KEY
+                        );
+                    """)
+                    await conn.execute("INSERT INTO schema_version (v) VALUES ($1) ON CONFLICT DO NOTHING;", SCHEMA_VERSION)
+            await conn.execute(
+                "INSERT INTO users (telegram_id, first_name) VALUES ($1, $2) ON CONFLICT (telegram_id) DO NOTHING;",
+                ADMIN_TELEGRAM_ID, 'Admin'
             )
-            conn.commit()
-    except psycopg2.Error as e:
+    except asyncpg.PostgresError as e:
         logger.error(f"Database setup error: {e}")
-    finally:
-        conn.close()
 
 # --- Helper Functions ---
-def is_authorized(user_id: int) -> bool:
-    """Checks if a user is authorized to use the bot."""
-    conn = get_db_connection()
-    if not conn: return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1 FROM users WHERE telegram_id = %s;", (user_id,))
-            return cur.fetchone() is not None
-    finally:
-        conn.close()
+AUTH_CACHE_TTL = 60  # seconds
+USERS_PAGE_SIZE = 500  # rows fetched per keyset page when listing users
+NOTIFY_CONCURRENCY = 25  # user notices in flight at once; caps parallelism, not messages per second
+_auth_cache = collections.OrderedDict()  # telegram_id -> (checked_at, authorized), oldest check first
+PERSONS_CACHE_TTL = 60  # seconds
+_persons_cache = {}  # with_accounts -> (fetched_at, persons)
+ACCOUNTS_CACHE_TTL = 60  # seconds
+_accounts_cache = {}  # person_id -> (fetched_at, accounts)
+_inflight = {}  # (id(cache), key) -> asyncio.Task loading that cache entry
+
+async def is_authorized(pool: asyncpg.Pool, user) -> bool:
+    """Checks if a user is authorized to use the bot, cached for AUTH_CACHE_TTL.
+
+    A cache miss also refreshes the user's stored first name in the same query.
+    """
+    now = time.monotonic()
+    checked_at, authorized = _auth_cache.get(user.id, (None, False))
+    if checked_at is not None and now - checked_at < AUTH_CACHE_TTL:
+        return authorized
+    authorized = await pool.fetchval(
+        "UPDATE users SET first_name = $2 WHERE telegram_id = $1 RETURNING 1;",
+        user.id, user.first_name
+    ) is not None
+    _auth_cache[user.id] = (now, authorized)
+    _auth_cache.move_to_end(user.id)
+    # Kept in check order, so expired entries (e.g. one-off unauthorized users) are pruned from the front
+    while now - next(iter(_auth_cache.values()))[0] >= AUTH_CACHE_TTL:
+        _auth_cache.popitem(last=False)
+    return authorized
+
+async def cached_fetch(cache: dict, key, ttl: float, query):
+    """Serves cache[key] while fresher than ttl, otherwise runs query() once for all concurrent callers.
+
+    A load that is invalidated while still in flight answers its callers but is not cached.
+    """
+    now = time.monotonic()
+    fetched_at, value = cache.get(key, (None, None))
+    if fetched_at is not None and now - fetched_at < ttl:
+        return value
+    flight = (id(cache), key)
+    task = _inflight.get(flight)
+    if task is None:
+        task = asyncio.ensure_future(query())
+        _inflight[flight] = task
+        def store(done):
+            if _inflight.get(flight) is done:
+                del _inflight[flight]
+                if not done.cancelled() and done.exception() is None:
+                    cache[key] = (now, done.result())
+        task.add_done_callback(store)
+    # Shielded so one caller giving up doesn't cancel the load for the others
+    return await asyncio.shield(task)
+
+def drop_cached(cache: dict, key=None) -> None:
+    """Invalidates one cache entry, or the whole cache, including loads still in flight."""
+    if key is None:
+        cache.clear()
+        for flight in [flight for flight in _inflight if flight[0] == id(cache)]:
+            del _inflight[flight]
+    else:
+        cache.pop(key, None)
+        _inflight.pop((id(cache), key), None)
+
+def invalidate_persons() -> None:
+    """Drops the cached persons lists after persons or accounts change."""
+    drop_cached(_persons_cache)
+
+def invalidate_accounts(person_id: int) -> None:
+    """Drops a person's cached accounts list after one of their accounts changes."""
+    drop_cached(_accounts_cache, person_id)
+
+def invalidate_authorization(user_id: int) -> None:
+    """Drops a cached access check after the user's access changes."""
+    _auth_cache.pop(user_id, None)
 
 def is_admin(user_id: int) -> bool:
     """Checks if a user is the admin."""
     return user_id == ADMIN_TELEGRAM_ID
 
+async def add_users(pool: asyncpg.Pool, user_ids: list) -> list:
+    """Adds users in a single statement, returning the ids that were new."""
+    rows = await pool.fetch(
+        "INSERT INTO users (telegram_id, first_name) SELECT unnest($1::bigint[]), 'N/A' ON CONFLICT (telegram_id) DO NOTHING RETURNING telegram_id;",
+        user_ids
+    )
+    return [telegram_id for (telegram_id,) in rows]
+
+ACCOUNT_COLUMNS = ("person_id", "bank_name", "account_number", "card_number", "shaba_number", "card_photo_id")
+
+ACCOUNTS_COPY_THRESHOLD = 500  # larger batches are streamed with COPY
+
+async def insert_accounts(conn: asyncpg.Pool | asyncpg.Connection, rows: list):
+    """Inserts accounts given as tuples in ACCOUNT_COLUMNS order, all in one pipelined batch.
+
+    Accepts a pool, or a connection so the insert can join a caller's transaction.
+    """
+    if len(rows) > ACCOUNTS_COPY_THRESHOLD:
+        # COPY sends the rows as one binary stream with no per-row statement execution
+        await conn.copy_records_to_table("accounts", records=rows, columns=ACCOUNT_COLUMNS)
+        return
+    await conn.executemany(
+        "INSERT INTO accounts (person_id, bank_name, account_number, card_number, shaba_number, card_photo_id) VALUES ($1, $2, $3, $4, $5, $6);",
+        rows
+    )
+
+async def import_accounts(pool: asyncpg.Pool, rows: list) -> int:
+    """Imports (person name, bank, account, card, shaba) rows in one transaction, creating missing persons.
+
+    Returns the number of accounts inserted.
+    """
+    names = list(dict.fromkeys(row[0] for row in rows))
+    async with pool.acquire() as conn, conn.transaction():
+        await conn.execute("INSERT INTO persons (name) SELECT unnest($1::text[]) ON CONFLICT (name) DO NOTHING;", names)
+        person_ids = dict(await conn.fetch("SELECT name, id FROM persons WHERE name = ANY($1::text[]);", names))
+        await insert_accounts(conn, [(person_ids[name], *fields, None) for name, *fields in rows])
+    return len(rows)
+
+class ImportLineError(Exception):
+    """Raised by parse_accounts_csv for the first line of an import file it can't accept."""
+    def __init__(self, line_no: int):
+        super().__init__(f"invalid import line {line_no}")
+        self.line_no = line_no
+
+def parse_accounts_csv(data: bytes) -> list:
+    """Parses an accounts import file: one account per line as name,bank,account,card,shaba.
+
+    Trailing columns may be left out and empty cells are stored as NULL.
+    Raises ImportLineError for the first line that is malformed or has no person name.
+    """
+    rows = []
+    reader = csv.reader(io.StringIO(data.decode("utf-8-sig")))
+    try:
+        for cells in reader:
+            cells = [cell.strip() or None for cell in cells[:5]]
+            if not any(cells): continue
+            if not cells[0]: raise ImportLineError(reader.line_num)
+            rows.append(tuple(cells + [None] * (5 - len(cells))))
+    except csv.Error:
+        # e.g. a field over csv.field_size_limit()
+        raise ImportLineError(reader.line_num) from None
+    return rows
+
+async def retry_after_flood(send, retries: int = 1):
+    """Awaits send(), waiting out up to `retries` flood-control rejections (HTTP 429).
+
+    The last RetryAfter is re-raised if Telegram is still refusing.
+    """
+    for attempt in range(retries):
+        try:
+            return await send()
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+    return await send()
+
+async def notify_user(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str) -> bool:
+    """Sends a notice to a user, returning False if it couldn't be delivered.
+
+    A flood-control rejection is retried once after the wait Telegram asks for.
+    """
+    try:
+        await retry_after_flood(functools.partial(context.bot.send_message, chat_id=chat_id, text=text))
+        return True
+    except Exception:
+        return False
+
 def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
     """Creates a ReplyKeyboardMarkup from a list of buttons."""
-    menu = [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
-    if header_buttons:
-        menu.insert(0, header_buttons)
+    menu = [header_buttons] if header_buttons else []
+    menu.extend(buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols))
     if footer_buttons:
         menu.extend(footer_buttons)
     return ReplyKeyboardMarkup(menu, resize_keyboard=True)
 
-async def get_persons_from_db(context: ContextTypes.DEFAULT_TYPE):
-    """Fetches all persons and stores them in context."""
-    conn = get_db_connection()
-    if not conn: return None
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, name FROM persons ORDER BY name;")
-            persons = cur.fetchall()
-            context.user_data['persons_list'] = {p[1]: p[0] for p in persons}
-            return persons
-    finally:
-        conn.close()
+async def split_message(lines, header=None, limit=MessageLimit.MAX_TEXT_LENGTH):
+    """Joins an async stream of lines into messages no longer than Telegram's limit.
+
+    Messages break only between lines; the header starts the first one. Nothing is
+    yielded if the stream is empty.
+    """
+    chunk = [header] if header else []
+    size = sum(len(line) + 1 for line in chunk)
+    seen = False
+    async for line in lines:
+        seen = True
+        if chunk and size + len(line) + 1 > limit:
+            yield "\n".join(chunk)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line) + 1
+    if seen:
+        yield "\n".join(chunk)
+
+@functools.lru_cache(maxsize=256)
+def cached_menu(buttons: tuple, n_cols: int, footer_buttons: tuple) -> ReplyKeyboardMarkup:
+    """build_menu memoized on its contents; the markup is immutable, so chats can share it."""
+    return build_menu(list(buttons), n_cols, footer_buttons=[list(row) for row in footer_buttons])
+
+def persons_keyboard(context: ContextTypes.DEFAULT_TYPE, footer_buttons):
+    """Builds the two-column keyboard of the persons last fetched by get_persons_from_db."""
+    return cached_menu(tuple(context.user_data['persons_list']), 2, tuple(map(tuple, footer_buttons)))
+
+def accounts_keyboard(context: ContextTypes.DEFAULT_TYPE):
+    """Builds the one-column keyboard of the accounts last fetched by get_accounts_for_person_from_db."""
+    return cached_menu(tuple(context.user_data['accounts_list']), 1, ((BACK_BUTTON, HOME_BUTTON),))
+
+async def get_persons_from_db(context: ContextTypes.DEFAULT_TYPE, with_accounts: bool = False):
+    """Fetches all persons (or only those that have accounts) and stores them in context.
+
+    The list is shared by every chat and cached for PERSONS_CACHE_TTL; writes call invalidate_persons().
+    """
+    if with_accounts:
+        sql = "SELECT p.id, p.name FROM persons p WHERE EXISTS (SELECT 1 FROM accounts a WHERE a.person_id = p.id) ORDER BY p.name;"
+    else:
+        sql = "SELECT id, name FROM persons ORDER BY name;"
+    query = functools.partial(context.bot_data['pool'].fetch, sql)
+    persons = await cached_fetch(_persons_cache, with_accounts, PERSONS_CACHE_TTL, query)
+    context.user_data['persons_list'] = {name: person_id for person_id, name in persons}
+    return persons
 
 async def get_accounts_for_person_from_db(person_id: int, context: ContextTypes.DEFAULT_TYPE):
-    """Fetches all accounts for a person and stores them in context."""
-    conn = get_db_connection()
-    if not conn: return None
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, bank_name, card_number FROM accounts WHERE person_id = %s;", (person_id,))
-            accounts = cur.fetchall()
-            # Use a more robust key, e.g., combining bank, card, and id
-            context.user_data['accounts_list'] = {f"{acc[1] or 'N/A'} - {acc[2] or 'N/A'} ({acc[0]})": acc[0] for acc in accounts}
-            return accounts
-    finally:
-        conn.close()
+    """Fetches all accounts for a person and stores them in context.
+
+    Cached per person for ACCOUNTS_CACHE_TTL; writes call invalidate_accounts().
+    """
+    accounts = await cached_fetch(
+        _accounts_cache, person_id, ACCOUNTS_CACHE_TTL,
+        functools.partial(
+            context.bot_data['pool'].fetch,
+            "SELECT id, bank_name, card_number FROM accounts WHERE person_id = $1 ORDER BY id;", person_id,
+        ),
+    )
+    # Use a more robust key, e.g., combining bank, card, and id
+    context.user_data['accounts_list'] = {f"{bank or 'N/A'} - {card or 'N/A'} ({account_id})": account_id for account_id, bank, card in accounts}
+    return accounts
 
 # --- Start & Main Menu Handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
-    if not is_authorized(user.id):
+    if not await is_authorized(context.bot_data['pool'], user):
         await update.message.reply_text("🚫 شما اجازه دسترسی به این ربات را ندارید.")
         return ConversationHandler.END
 
-    conn = get_db_connection()
-    if conn:
-      try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO users (telegram_id, first_name) VALUES (%s, %s) ON CONFLICT (telegram_id) DO UPDATE SET first_name = EXCLUDED.first_name;",
-                (user.id, user.first_name)
-            )
-            conn.commit()
-      finally:
-        conn.close()
-
-    keyboard = [["مشاهده اطلاعات 📄"], ["ویرایش ✏️", "ادمین 🛠️"]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    context.user_data.pop('last_photo_sent', None)  # a new session re-sends card images
+    reply_markup = MAIN_MENU_ADMIN_MARKUP if is_admin(user.id) else MAIN_MENU_USER_MARKUP
     await update.message.reply_text(f"سلام {user.first_name}! به دفترچه بانکی خوش آمدید.", reply_markup=reply_markup)
     return MAIN_MENU
 
@@ -216,89 +448,131 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("🚫 این بخش فقط برای ادمین است.")
         return MAIN_MENU
-    keyboard = [["مشاهده کاربران مجاز 👁️"], ["افزودن کاربر ➕", "حذف کاربر ➖"], [HOME_BUTTON]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("منوی ادمین:", reply_markup=reply_markup)
+    await update.message.reply_text("منوی ادمین:", reply_markup=ADMIN_MENU_MARKUP)
     return ADMIN_MENU
 
+async def iter_users(pool: asyncpg.Pool):
+    """Yields (telegram_id, first_name) ordered by name, one keyset page per query.
+
+    No connection or transaction is held between pages, so callers may await freely while iterating.
+    """
+    rows = await pool.fetch("SELECT telegram_id, first_name FROM users ORDER BY first_name, telegram_id LIMIT $1;", USERS_PAGE_SIZE)
+    while rows:
+        for row in rows: yield row
+        if len(rows) < USERS_PAGE_SIZE: return
+        last_id, last_name = rows[-1]
+        rows = await pool.fetch(
+            "SELECT telegram_id, first_name FROM users WHERE (first_name, telegram_id) > ($1, $2) ORDER BY first_name, telegram_id LIMIT $3;",
+            last_name, last_id, USERS_PAGE_SIZE
+        )
+
 async def admin_view_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    conn = get_db_connection()
-    if not conn:
-        await update.message.reply_text("خطا در اتصال به پایگاه داده.")
-        return ADMIN_MENU
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT telegram_id, first_name FROM users ORDER BY first_name;")
-            users = cur.fetchall()
-            message = "لیست کاربران مجاز:\n\n" + "\n".join([f"👤 {fn}\n🆔 `{tid}`" for tid, fn in users]) if users else "هیچ کاربری ثبت نشده."
-            await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN_V2)
-    finally: conn.close()
+    sent = False
+    lines = (f"👤 {escape_markdown(fn, version=2)}\n🆔 `{tid}`" async for tid, fn in iter_users(context.bot_data['pool']))
+    # Long lists are sent as several messages instead of failing with "message is too long"
+    async for message in split_message(lines, header="لیست کاربران مجاز:\n"):
+        try:
+            await retry_after_flood(functools.partial(update.message.reply_text, message, parse_mode=ParseMode.MARKDOWN_V2), retries=3)
+        except RetryAfter as e:
+            logger.warning(f"Users list cut short by flood control: {e}")
+            await asyncio.sleep(e.retry_after)
+            await update.message.reply_text("⚠️ ارسال لیست به دلیل محدودیت تلگرام متوقف شد. کمی بعد دوباره تلاش کنید.")
+            return ADMIN_MENU
+        sent = True
+    if not sent:
+        await update.message.reply_text("هیچ کاربری ثبت نشده.")
     return ADMIN_MENU
 
 async def admin_prompt_add_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text("شناسه عددی تلگرام کاربر جدید را وارد کنید:", reply_markup=ReplyKeyboardMarkup([[BACK_BUTTON]], resize_keyboard=True))
+    await update.message.reply_text("شناسه عددی تلگرام کاربر جدید را وارد کنید (برای چند کاربر، شناسه‌ها را با فاصله جدا کنید):", reply_markup=BACK_MARKUP)
     return ADMIN_ADD_USER
 
 async def admin_add_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    try: user_id_to_add = int(update.message.text)
-    except (ValueError, TypeError):
+    parts = update.message.text.replace(',', ' ').split()
+    if not parts or not all(part.isdecimal() for part in parts):
         await update.message.reply_text("❌ شناسه نامعتبر است. یک عدد وارد کنید.")
         return ADMIN_ADD_USER
-    conn = get_db_connection()
-    if not conn:
-        await update.message.reply_text("خطا در اتصال به پایگاه داده.")
+    user_ids = list(dict.fromkeys(map(int, parts)))
+    try: added = await add_users(context.bot_data['pool'], user_ids)
+    except asyncpg.PostgresError as e:
+        await update.message.reply_text("❌ خطایی در افزودن کاربر رخ داد.")
         return await admin_menu(update, context)
+    for user_id in added: invalidate_authorization(user_id)
+
+    # Fan the welcome notices out with bounded parallelism; notify_user waits out Telegram's 429s
+    semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+    async def welcome(user_id):
+        async with semaphore:
+            return await notify_user(context, user_id, "🎉 دسترسی شما به ربات فعال شد. /start را بزنید.")
+    notified = await asyncio.gather(*(welcome(user_id) for user_id in added))
+
+    new_ids = set(added)
+    async def summary():
+        for user_id, ok in zip(added, notified):
+            yield f"✅ کاربر `{user_id}` اضافه شد و به او اطلاع داده شد\\." if ok else f"✅ کاربر `{user_id}` اضافه شد، اما ارسال پیام به او ناموفق بود\\."
+        for user_id in user_ids:
+            if user_id not in new_ids: yield f"⚠️ کاربر `{user_id}` از قبل وجود دارد\\."
+    # A large batch would overflow a single message, so the report is split like the users list
+    async for message in split_message(summary()):
+        await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN_V2)
+    return await admin_menu(update, context)
+
+async def admin_prompt_import_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("فایل CSV حساب‌ها را بفرستید. هر خط: نام شخص، بانک، شماره حساب، شماره کارت، شبا", reply_markup=BACK_MARKUP)
+    return ADMIN_IMPORT_ACCOUNTS
+
+async def admin_import_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1 FROM users WHERE telegram_id = %s;", (user_id_to_add,))
-            if cur.fetchone():
-                await update.message.reply_text("⚠️ این کاربر از قبل وجود دارد.")
-                return await admin_menu(update, context)
-            cur.execute("INSERT INTO users (telegram_id, first_name) VALUES (%s, %s);", (user_id_to_add, 'N/A'))
-            conn.commit()
-        try:
-            await context.bot.send_message(chat_id=user_id_to_add, text="🎉 دسترسی شما به ربات فعال شد. /start را بزنید.")
-            await update.message.reply_text(f"✅ کاربر `{user_id_to_add}` اضافه شد و به او اطلاع داده شد.", parse_mode=ParseMode.MARKDOWN_V2)
-        except Exception as e:
-            await update.message.reply_text(f"✅ کاربر `{user_id_to_add}` اضافه شد، اما ارسال پیام به او ناموفق بود.", parse_mode=ParseMode.MARKDOWN_V2)
-    except psycopg2.Error as e: await update.message.reply_text("❌ خطایی در افزودن کاربر رخ داد.")
-    finally: conn.close()
+        data = await (await update.message.document.get_file()).download_as_bytearray()
+        rows = parse_accounts_csv(bytes(data))
+    except TelegramError:
+        await update.message.reply_text("❌ دریافت فایل ناموفق بود.")
+        return ADMIN_IMPORT_ACCOUNTS
+    except UnicodeDecodeError:
+        await update.message.reply_text("❌ فایل باید با کدگذاری UTF-8 باشد.")
+        return ADMIN_IMPORT_ACCOUNTS
+    except ImportLineError as e:
+        await update.message.reply_text(f"❌ خط {e.line_no} فایل نامعتبر است؛ هر خط باید با نام شخص شروع شود.")
+        return ADMIN_IMPORT_ACCOUNTS
+    if not rows:
+        await update.message.reply_text("❌ فایل خالی است.")
+        return ADMIN_IMPORT_ACCOUNTS
+    try: imported = await import_accounts(context.bot_data['pool'], rows)
+    except asyncpg.PostgresError:
+        await update.message.reply_text("❌ خطایی در ورود حساب‌ها رخ داد.")
+        return await admin_menu(update, context)
+    invalidate_persons()
+    drop_cached(_accounts_cache)
+    await update.message.reply_text(f"✅ {imported} حساب وارد شد.")
     return await admin_menu(update, context)
 
 async def admin_prompt_remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    conn = get_db_connection()
-    if not conn: return await admin_menu(update, context)
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT telegram_id, first_name FROM users WHERE telegram_id != %s;", (ADMIN_TELEGRAM_ID,))
-            users = cur.fetchall()
-            if not users:
-                await update.message.reply_text("هیچ کاربری برای حذف وجود ندارد.")
-                return await admin_menu(update, context)
-            buttons = [f"{fn} ({tid})" for tid, fn in users]
-            keyboard = build_menu(buttons, 1, footer_buttons=[[BACK_BUTTON]])
-            await update.message.reply_text("کدام کاربر را حذف می‌کنید؟", reply_markup=keyboard)
-            return ADMIN_REMOVE_USER
-    finally: conn.close()
+    users = await context.bot_data['pool'].fetch("SELECT telegram_id, first_name FROM users WHERE telegram_id != $1;", ADMIN_TELEGRAM_ID)
+    if not users:
+        await update.message.reply_text("هیچ کاربری برای حذف وجود ندارد.")
+        return await admin_menu(update, context)
+    buttons = [f"{fn} ({tid})" for tid, fn in users]
+    keyboard = build_menu(buttons, 1, footer_buttons=[[BACK_BUTTON]])
+    await update.message.reply_text("کدام کاربر را حذف می‌کنید؟", reply_markup=keyboard)
+    return ADMIN_REMOVE_USER
 
 async def admin_remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    try: user_id_to_remove = int(update.message.text.split('(')[-1].strip(')'))
-    except (ValueError, TypeError, IndexError):
+    match = USER_BUTTON_RE.search(update.message.text)
+    if not match:
         await update.message.reply_text("❌ انتخاب نامعتبر. از دکمه‌ها استفاده کنید.")
         return ADMIN_REMOVE_USER
-    conn = get_db_connection()
-    if not conn: return await admin_menu(update, context)
+    user_id_to_remove = int(match.group(1))
     try:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM users WHERE telegram_id = %s;", (user_id_to_remove,))
-            conn.commit()
-            if cur.rowcount > 0:
-                await update.message.reply_text(f"✅ کاربر `{user_id_to_remove}` حذف شد.", parse_mode=ParseMode.MARKDOWN_V2)
-                try: await context.bot.send_message(chat_id=user_id_to_remove, text="🚫 دسترسی شما به ربات لغو شد.")
-                except Exception: pass
-            else: await update.message.reply_text("کاربر یافت نشد.")
-    except psycopg2.Error: await update.message.reply_text("❌ خطایی در حذف رخ داد.")
-    finally: conn.close()
+        removed = await context.bot_data['pool'].fetchval("DELETE FROM users WHERE telegram_id = $1 RETURNING telegram_id;", user_id_to_remove)
+        if removed is not None:
+            invalidate_authorization(user_id_to_remove)
+            # The admin's confirmation doesn't depend on reaching the user
+            await asyncio.gather(
+                update.message.reply_text(f"✅ کاربر `{user_id_to_remove}` حذف شد\\.", parse_mode=ParseMode.MARKDOWN_V2),
+                notify_user(context, user_id_to_remove, "🚫 دسترسی شما به ربات لغو شد."),
+            )
+        else: await update.message.reply_text("کاربر یافت نشد.")
+    except asyncpg.PostgresError: await update.message.reply_text("❌ خطایی در حذف رخ داد.")
     return await admin_menu(update, context)
 
 
@@ -308,8 +582,7 @@ async def view_choose_person(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not persons:
         await update.message.reply_text("هیچ شخصی ثبت نشده. از منوی ویرایش، شخص جدید اضافه کنید.")
         return await start(update, context)
-    buttons = [p[1] for p in persons]
-    keyboard = build_menu(buttons, 2, footer_buttons=[[HOME_BUTTON]])
+    keyboard = persons_keyboard(context, [[HOME_BUTTON]])
     await update.message.reply_text("اطلاعات کدام شخص را می‌خواهید؟", reply_markup=keyboard)
     return VIEW_CHOOSE_PERSON
 
@@ -325,15 +598,12 @@ async def view_choose_account(update: Update, context: ContextTypes.DEFAULT_TYPE
     accounts = await get_accounts_for_person_from_db(person_id, context)
     if not accounts:
         await update.message.reply_text(f"هیچ حسابی برای '{person_name}' ثبت نشده.")
-        # Re-display person list
-        persons = await get_persons_from_db(context)
-        buttons = [p[1] for p in persons]
-        keyboard = build_menu(buttons, 2, footer_buttons=[[HOME_BUTTON]])
+        # Re-display person list from the one fetched for this menu
+        keyboard = persons_keyboard(context, [[HOME_BUTTON]])
         await update.message.reply_text("شخص دیگری را انتخاب کنید:", reply_markup=keyboard)
         return VIEW_CHOOSE_PERSON
     
-    buttons = list(context.user_data['accounts_list'].keys())
-    keyboard = build_menu(buttons, 1, footer_buttons=[[BACK_BUTTON, HOME_BUTTON]])
+    keyboard = accounts_keyboard(context)
     await update.message.reply_text(f"حساب‌های '{person_name}'. کدام حساب؟", reply_markup=keyboard)
     return VIEW_CHOOSE_ACCOUNT
 
@@ -344,37 +614,56 @@ async def view_display_account_details(update: Update, context: ContextTypes.DEF
         await update.message.reply_text("❌ انتخاب نامعتبر. از دکمه‌ها استفاده کنید.")
         return VIEW_CHOOSE_ACCOUNT
     
-    conn = get_db_connection()
-    if not conn:
-        await update.message.reply_text("خطا در اتصال به پایگاه داده.")
-        return MAIN_MENU
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT bank_name, account_number, card_number, shaba_number, card_photo_id FROM accounts WHERE id = %s;", (account_id,))
-            account = cur.fetchone()
-            if not account:
-                await update.message.reply_text("خطا: حساب یافت نشد.")
-                return await view_choose_account(update, context) # Reshow accounts
-            
-            bank, acc_num, card_num, shaba, photo_id = account
-            person_name = context.user_data.get('selected_person_name', 'N/A')
-            message = f"📄 *اطلاعات حساب*\n\n👤 *صاحب:* {person_name}\n🏦 *بانک:* {bank or 'N/A'}\n"
-            if acc_num: message += f"🔢 *حساب:*\n`{acc_num}`\n"
-            if card_num: message += f"💳 *کارت:*\n`{card_num}`\n"
-            if shaba: message += f"🌐 *شبا:*\n`{shaba}`\n"
-            
-            await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=update.message.reply_keyboard)
-            if photo_id:
-                try: await context.bot.send_photo(chat_id=update.effective_chat.id, photo=photo_id, caption="🖼️ تصویر کارت")
-                except: await update.message.reply_text("⚠️ تصویر کارت قابل بارگذاری نبود.")
-    finally: conn.close()
+    account = await context.bot_data['pool'].fetchrow("SELECT bank_name, account_number, card_number, shaba_number, card_photo_id FROM accounts WHERE id = $1;", account_id)
+    if not account:
+        await update.message.reply_text("خطا: حساب یافت نشد.")
+        return await view_choose_account(update, context) # Reshow accounts
+
+    bank, acc_num, card_num, shaba, photo_id = account
+    person_name = context.user_data.get('selected_person_name', 'N/A')
+    parts = [f"📄 *اطلاعات حساب*\n\n👤 *صاحب:* {escape_markdown(person_name, version=2)}\n🏦 *بانک:* {escape_markdown(bank or 'N/A', version=2)}\n"]
+    parts.extend(
+        f"{label}\n`{escape_markdown(value, version=2, entity_type='code')}`\n"
+        for label, value in (("🔢 *حساب:*", acc_num), ("💳 *کارت:*", card_num), ("🌐 *شبا:*", shaba)) if value
+    )
+    message = "".join(parts)
+
+    # Tracks only the account shown last: cleared here, set again once its photo is on screen
+    last_photo_sent = context.user_data.pop('last_photo_sent', None)
+    if photo_id and photo_id == last_photo_sent:
+        context.user_data['last_photo_sent'] = photo_id
+        photo_id = None  # the chat just received this card image; don't upload it again
+    if photo_id and len(message) <= MessageLimit.CAPTION_LENGTH:
+        # One message instead of two: the details ride along as the photo's caption
+        try:
+            await update.message.reply_photo(photo_id, caption=message, parse_mode=ParseMode.MARKDOWN_V2)
+            context.user_data['last_photo_sent'] = photo_id
+            return VIEW_CHOOSE_ACCOUNT
+        except BadRequest as e:
+            # Only a rejected file_id falls back to text; timeouts and flood control propagate,
+            # since the photo may already have been delivered
+            logger.warning(f"Could not send card photo {photo_id}: {e}")
+            photo_id = None
+            message += "\n⚠️ تصویر کارت قابل بارگذاری نبود\\."
+    await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN_V2)
+    if photo_id:
+        # Don't hold the handler (and this chat's next update) on the upload
+        context.application.create_task(send_card_photo(update, context, photo_id), update=update)
     return VIEW_CHOOSE_ACCOUNT # Stay in the same state to allow viewing another account
 
+async def send_card_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, photo_id: str) -> None:
+    """Sends a stored card image, with a notice if Telegram can't deliver it."""
+    try:
+        # Silent: it follows the details message the user was just notified about
+        await context.bot.send_photo(chat_id=update.effective_chat.id, photo=photo_id, caption="🖼️ تصویر کارت", disable_notification=True)
+        context.user_data['last_photo_sent'] = photo_id
+    except TelegramError as e:
+        logger.warning(f"Could not send card photo {photo_id}: {e}")
+        await update.message.reply_text("⚠️ تصویر کارت قابل بارگذاری نبود.")
+
 # --- Edit Menu ---
 async def edit_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    keyboard = [["اضافه کردن ➕"], ["تغییر دادن 📝", "حذف کردن 🗑️"], [HOME_BUTTON]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("منوی ویرایش:", reply_markup=reply_markup)
+    await update.message.reply_text("منوی ویرایش:", reply_markup=EDIT_MENU_MARKUP)
     context.user_data.clear() # Clear previous edit data
     return EDIT_MENU
 
@@ -384,12 +673,11 @@ async def edit_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 # I will write them out again to be complete as requested.
 
 async def add_choose_person_type(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    keyboard = [["شخص جدید 👤", "شخص موجود 👥"], [BACK_BUTTON, HOME_BUTTON]]
-    await update.message.reply_text("برای چه کسی حساب اضافه می‌کنید؟", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    await update.message.reply_text("برای چه کسی حساب اضافه می‌کنید؟", reply_markup=ADD_PERSON_TYPE_MARKUP)
     return ADD_CHOOSE_PERSON_TYPE
 
 async def add_prompt_new_person_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text("نام کامل شخص جدید را وارد کنید:", reply_markup=ReplyKeyboardMarkup([[BACK_BUTTON, HOME_BUTTON]], resize_keyboard=True))
+    await update.message.reply_text("نام کامل شخص جدید را وارد کنید:", reply_markup=NAV_MARKUP)
     return ADD_NEW_PERSON_NAME
 
 async def add_save_new_person_and_prompt_bank(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -397,25 +685,20 @@ async def add_save_new_person_and_prompt_bank(update: Update, context: ContextTy
     if not person_name:
         await update.message.reply_text("نام نمی‌تواند خالی باشد.")
         return ADD_NEW_PERSON_NAME
-    conn = get_db_connection()
-    if not conn: return await edit_menu(update, context)
     try:
-        with conn.cursor() as cur:
-            cur.execute("INSERT INTO persons (name) VALUES (%s) RETURNING id;", (person_name,))
-            person_id = cur.fetchone()[0]
-            conn.commit()
-            context.user_data['new_account_person_id'] = person_id
-            await update.message.reply_text(f"✅ شخص '{person_name}' اضافه شد. حالا اطلاعات حساب را وارد کنید.")
-    except psycopg2.IntegrityError:
+        person_id = await context.bot_data['pool'].fetchval("INSERT INTO persons (name) VALUES ($1) RETURNING id;", person_name)
+        invalidate_persons()
+        context.user_data['new_account_person_id'] = person_id
+        await update.message.reply_text(f"✅ شخص '{person_name}' اضافه شد. حالا اطلاعات حساب را وارد کنید.")
+    except asyncpg.UniqueViolationError:
         await update.message.reply_text("❌ شخصی با این نام وجود دارد.")
         return ADD_NEW_PERSON_NAME
-    except psycopg2.Error as e:
+    except asyncpg.PostgresError as e:
         await update.message.reply_text("❌ خطایی در افزودن شخص رخ داد.")
         return await edit_menu(update, context)
-    finally: conn.close()
 
     context.user_data['new_account'] = {}
-    await update.message.reply_text("۱/۵ - نام بانک:", reply_markup=ReplyKeyboardMarkup([[SKIP_BUTTON], [BACK_BUTTON, HOME_BUTTON]], resize_keyboard=True))
+    await update.message.reply_text("۱/۵ - نام بانک:", reply_markup=SKIP_NAV_MARKUP)
     return ADD_ACCOUNT_BANK
 
 async def add_choose_existing_person(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -423,8 +706,7 @@ async def add_choose_existing_person(update: Update, context: ContextTypes.DEFAU
     if not persons:
         await update.message.reply_text("هیچ شخصی نیست. ابتدا 'شخص جدید' اضافه کنید.")
         return await add_choose_person_type(update, context)
-    buttons = [p[1] for p in persons]
-    keyboard = build_menu(buttons, 2, footer_buttons=[[BACK_BUTTON, HOME_BUTTON]])
+    keyboard = persons_keyboard(context, [[BACK_BUTTON, HOME_BUTTON]])
     await update.message.reply_text("برای کدام شخص حساب اضافه می‌کنید؟", reply_markup=keyboard)
     return ADD_CHOOSE_EXISTING_PERSON
 
@@ -434,27 +716,27 @@ async def add_set_existing_person_and_prompt_bank(update: Update, context: Conte
     if not person_id: return ADD_CHOOSE_EXISTING_PERSON
     context.user_data['new_account_person_id'] = person_id
     context.user_data['new_account'] = {}
-    await update.message.reply_text("۱/۵ - نام بانک:", reply_markup=ReplyKeyboardMarkup([[SKIP_BUTTON], [BACK_BUTTON, HOME_BUTTON]], resize_keyboard=True))
+    await update.message.reply_text("۱/۵ - نام بانک:", reply_markup=SKIP_NAV_MARKUP)
     return ADD_ACCOUNT_BANK
 
 async def add_account_get_bank(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_account']['bank_name'] = None if update.message.text == SKIP_BUTTON else update.message.text
-    await update.message.reply_text("۲/۵ - شماره حساب:", reply_markup=update.message.reply_keyboard)
+    await update.message.reply_text("۲/۵ - شماره حساب:", reply_markup=SKIP_NAV_MARKUP)
     return ADD_ACCOUNT_NUMBER
 
 async def add_account_get_number(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_account']['account_number'] = None if update.message.text == SKIP_BUTTON else update.message.text
-    await update.message.reply_text("۳/۵ - شماره کارت:", reply_markup=update.message.reply_keyboard)
+    await update.message.reply_text("۳/۵ - شماره کارت:", reply_markup=SKIP_NAV_MARKUP)
     return ADD_ACCOUNT_CARD
 
 async def add_account_get_card(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_account']['card_number'] = None if update.message.text == SKIP_BUTTON else update.message.text
-    await update.message.reply_text("۴/۵ - شماره شبا (بدون IR):", reply_markup=update.message.reply_keyboard)
+    await update.message.reply_text("۴/۵ - شماره شبا (بدون IR):", reply_markup=SKIP_NAV_MARKUP)
     return ADD_ACCOUNT_SHABA
 
 async def add_account_get_shaba(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_account']['shaba_number'] = None if update.message.text == SKIP_BUTTON else update.message.text
-    await update.message.reply_text("۵/۵ - تصویر کارت:", reply_markup=update.message.reply_keyboard)
+    await update.message.reply_text("۵/۵ - تصویر کارت:", reply_markup=SKIP_NAV_MARKUP)
     return ADD_ACCOUNT_PHOTO
 
 async def add_account_get_photo_and_save(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -466,18 +748,13 @@ async def add_account_get_photo_and_save(update: Update, context: ContextTypes.D
         await update.message.reply_text("لطفاً عکس بفرستید یا رد شوید.")
         return ADD_ACCOUNT_PHOTO
     if not person_id: return await start(update, context)
-    conn = get_db_connection()
-    if not conn: return await edit_menu(update, context)
     try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO accounts (person_id, bank_name, account_number, card_number, shaba_number, card_photo_id) VALUES (%s, %s, %s, %s, %s, %s);",
-                (person_id, new_account.get('bank_name'), new_account.get('account_number'), new_account.get('card_number'), new_account.get('shaba_number'), new_account.get('card_photo_id'))
-            )
-            conn.commit()
-            await update.message.reply_text("✅ حساب جدید با موفقیت ثبت شد.")
-    except psycopg2.Error as e: await update.message.reply_text("❌ خطایی در ذخیره حساب رخ داد.")
-    finally: conn.close()
+        new_account['person_id'] = person_id
+        await insert_accounts(context.bot_data['pool'], [tuple(new_account.get(column) for column in ACCOUNT_COLUMNS)])
+        invalidate_persons()
+        invalidate_accounts(person_id)
+        await update.message.reply_text("✅ حساب جدید با موفقیت ثبت شد.")
+    except asyncpg.PostgresError as e: await update.message.reply_text("❌ خطایی در ذخیره حساب رخ داد.")
     context.user_data.pop('new_account', None)
     context.user_data.pop('new_account_person_id', None)
     return await edit_menu(update, context)
@@ -486,8 +763,7 @@ async def add_account_get_photo_and_save(update: Update, context: ContextTypes.D
 # ... (Functions from previous response: delete_choose_type, ..., delete_execute_account_deletion)
 # I will write them out again to be complete as requested.
 async def delete_choose_type(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    keyboard = [["حذف شخص 👤", "حذف حساب 💳"], [BACK_BUTTON, HOME_BUTTON]]
-    await update.message.reply_text("قصد حذف چه چیزی را دارید؟\n\n⚠️ *توجه:* با حذف شخص، تمام حساب‌هایش نیز حذف می‌شود.", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True), parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text("قصد حذف چه چیزی را دارید؟\n\n⚠️ *توجه:* با حذف شخص، تمام حساب‌هایش نیز حذف می‌شود\\.", reply_markup=DELETE_TYPE_MARKUP, parse_mode=ParseMode.MARKDOWN_V2)
     return DELETE_CHOOSE_TYPE
 
 async def delete_choose_person(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -495,8 +771,7 @@ async def delete_choose_person(update: Update, context: ContextTypes.DEFAULT_TYP
     if not persons:
         await update.message.reply_text("هیچ شخصی برای حذف نیست.")
         return await edit_menu(update, context)
-    buttons = [p[1] for p in persons]
-    keyboard = build_menu(buttons, 2, footer_buttons=[[BACK_BUTTON, HOME_BUTTON]])
+    keyboard = persons_keyboard(context, [[BACK_BUTTON, HOME_BUTTON]])
     await update.message.reply_text("کدام شخص را حذف می‌کنید؟", reply_markup=keyboard)
     return DELETE_CHOOSE_PERSON
 
@@ -505,22 +780,18 @@ async def delete_confirm_person(update: Update, context: ContextTypes.DEFAULT_TY
     person_id = context.user_data.get('persons_list', {}).get(person_name)
     if not person_id: return DELETE_CHOOSE_PERSON
     context.user_data['person_to_delete'] = {'id': person_id, 'name': person_name}
-    keyboard = [["بله، حذف کن ✅", "نه، لغو کن ❌"], [HOME_BUTTON]]
-    await update.message.reply_text(f"‼️ *اخطار نهایی*\nآیا از حذف '{person_name}' و تمام حساب‌هایش مطمئنید؟", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True), parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text(f"‼️ *اخطار نهایی*\nآیا از حذف '{escape_markdown(person_name, version=2)}' و تمام حساب‌هایش مطمئنید؟", reply_markup=CONFIRM_DELETE_MARKUP, parse_mode=ParseMode.MARKDOWN_V2)
     return DELETE_CONFIRM_PERSON
 
 async def delete_execute_person_deletion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     person_to_delete = context.user_data.get('person_to_delete')
     if not person_to_delete: return await edit_menu(update, context)
-    conn = get_db_connection()
-    if not conn: return await edit_menu(update, context)
     try:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM persons WHERE id = %s;", (person_to_delete['id'],))
-            conn.commit()
-            await update.message.reply_text(f"✅ شخص '{person_to_delete['name']}' حذف شد.")
-    except psycopg2.Error: await update.message.reply_text("❌ خطایی در حذف رخ داد.")
-    finally: conn.close()
+        await context.bot_data['pool'].execute("DELETE FROM persons WHERE id = $1;", person_to_delete['id'])
+        invalidate_persons()
+        invalidate_accounts(person_to_delete['id'])  # removed by ON DELETE CASCADE
+        await update.message.reply_text(f"✅ شخص '{person_to_delete['name']}' حذف شد.")
+    except asyncpg.PostgresError: await update.message.reply_text("❌ خطایی در حذف رخ داد.")
     context.user_data.pop('person_to_delete', None)
     return await edit_menu(update, context)
 
@@ -531,12 +802,12 @@ async def delete_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     return await edit_menu(update, context)
 
 async def delete_choose_account_for_person(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    persons = await get_persons_from_db(context)
+    # Only offer persons that actually have an account to delete
+    persons = await get_persons_from_db(context, with_accounts=True)
     if not persons:
-        await update.message.reply_text("هیچ شخصی نیست.")
+        await update.message.reply_text("هیچ حسابی ثبت نشده.")
         return await edit_menu(update, context)
-    buttons = [p[1] for p in persons]
-    keyboard = build_menu(buttons, 2, footer_buttons=[[BACK_BUTTON, HOME_BUTTON]])
+    keyboard = persons_keyboard(context, [[BACK_BUTTON, HOME_BUTTON]])
     await update.message.reply_text("حساب مورد نظر برای کدام شخص است؟", reply_markup=keyboard)
     return DELETE_CHOOSE_ACCOUNT_FOR_PERSON
 
@@ -548,8 +819,7 @@ async def delete_choose_account(update: Update, context: ContextTypes.DEFAULT_TY
     if not accounts:
         await update.message.reply_text(f"هیچ حسابی برای '{person_name}' نیست.")
         return await delete_choose_account_for_person(update, context)
-    buttons = list(context.user_data['accounts_list'].keys())
-    keyboard = build_menu(buttons, 1, footer_buttons=[[BACK_BUTTON, HOME_BUTTON]])
+    keyboard = accounts_keyboard(context)
     await update.message.reply_text(f"کدام حساب '{person_name}' را حذف می‌کنید؟", reply_markup=keyboard)
     return DELETE_CHOOSE_ACCOUNT
 
@@ -558,22 +828,18 @@ async def delete_confirm_account(update: Update, context: ContextTypes.DEFAULT_T
     account_id = context.user_data.get('accounts_list', {}).get(account_key)
     if not account_id: return DELETE_CHOOSE_ACCOUNT
     context.user_data['account_to_delete'] = {'id': account_id, 'key': account_key}
-    keyboard = [["بله، حذف کن ✅", "نه، لغو کن ❌"], [HOME_BUTTON]]
-    await update.message.reply_text(f"‼️ *اخطار نهایی*\nآیا از حذف حساب '{account_key}' مطمئنید؟", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True), parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text(f"‼️ *اخطار نهایی*\nآیا از حذف حساب '{escape_markdown(account_key, version=2)}' مطمئنید؟", reply_markup=CONFIRM_DELETE_MARKUP, parse_mode=ParseMode.MARKDOWN_V2)
     return DELETE_CONFIRM_ACCOUNT
 
 async def delete_execute_account_deletion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     account_to_delete = context.user_data.get('account_to_delete')
     if not account_to_delete: return await edit_menu(update, context)
-    conn = get_db_connection()
-    if not conn: return await edit_menu(update, context)
     try:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM accounts WHERE id = %s;", (account_to_delete['id'],))
-            conn.commit()
-            await update.message.reply_text(f"✅ حساب '{account_to_delete['key']}' حذف شد.")
-    except psycopg2.Error: await update.message.reply_text("❌ خطایی در حذف رخ داد.")
-    finally: conn.close()
+        person_id = await context.bot_data['pool'].fetchval("DELETE FROM accounts WHERE id = $1 RETURNING person_id;", account_to_delete['id'])
+        invalidate_persons()
+        invalidate_accounts(person_id)
+        await update.message.reply_text(f"✅ حساب '{account_to_delete['key']}' حذف شد.")
+    except asyncpg.PostgresError: await update.message.reply_text("❌ خطایی در حذف رخ داد.")
     context.user_data.pop('account_to_delete', None)
     return await edit_menu(update, context)
 
@@ -583,8 +849,7 @@ async def change_choose_person(update: Update, context: ContextTypes.DEFAULT_TYP
     if not persons:
         await update.message.reply_text("هیچ شخصی برای ویرایش وجود ندارد.")
         return await edit_menu(update, context)
-    buttons = [p[1] for p in persons]
-    keyboard = build_menu(buttons, 2, footer_buttons=[[BACK_BUTTON, HOME_BUTTON]])
+    keyboard = persons_keyboard(context, [[BACK_BUTTON, HOME_BUTTON]])
     await update.message.reply_text("اطلاعات کدام شخص را می‌خواهید تغییر دهید؟", reply_markup=keyboard)
     return CHANGE_CHOOSE_PERSON
 
@@ -595,13 +860,12 @@ async def change_choose_target(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("❌ انتخاب نامعتبر. از دکمه‌ها استفاده کنید.")
         return CHANGE_CHOOSE_PERSON
     context.user_data['change_person'] = {'id': person_id, 'name': person_name}
-    keyboard = [["تغییر نام شخص 👤", "ویرایش یک حساب 💳"], [BACK_BUTTON, HOME_BUTTON]]
-    await update.message.reply_text(f"چه تغییری برای '{person_name}' ایجاد می‌کنید؟", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    await update.message.reply_text(f"چه تغییری برای '{person_name}' ایجاد می‌کنید؟", reply_markup=CHANGE_TARGET_MARKUP)
     return CHANGE_CHOOSE_TARGET
 
 async def change_prompt_person_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     person_name = context.user_data.get('change_person', {}).get('name', 'این شخص')
-    await update.message.reply_text(f"نام جدید را برای '{person_name}' وارد کنید:", reply_markup=ReplyKeyboardMarkup([[BACK_BUTTON, HOME_BUTTON]], resize_keyboard=True))
+    await update.message.reply_text(f"نام جدید را برای '{person_name}' وارد کنید:", reply_markup=NAV_MARKUP)
     return CHANGE_PROMPT_PERSON_NAME
 
 async def change_save_person_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -610,16 +874,12 @@ async def change_save_person_name(update: Update, context: ContextTypes.DEFAULT_
     if not new_name or not person_info:
         await update.message.reply_text("نام نمی‌تواند خالی باشد.")
         return CHANGE_PROMPT_PERSON_NAME
-    conn = get_db_connection()
-    if not conn: return await edit_menu(update, context)
     try:
-        with conn.cursor() as cur:
-            cur.execute("UPDATE persons SET name = %s WHERE id = %s;", (new_name, person_info['id']))
-            conn.commit()
-            await update.message.reply_text(f"✅ نام شخص با موفقیت به '{new_name}' تغییر یافت.")
-    except psycopg2.IntegrityError: await update.message.reply_text("❌ شخصی با این نام از قبل وجود دارد.")
-    except psycopg2.Error: await update.message.reply_text("❌ خطایی در تغییر نام رخ داد.")
-    finally: conn.close()
+        await context.bot_data['pool'].execute("UPDATE persons SET name = $1 WHERE id = $2;", new_name, person_info['id'])
+        invalidate_persons()
+        await update.message.reply_text(f"✅ نام شخص با موفقیت به '{new_name}' تغییر یافت.")
+    except asyncpg.UniqueViolationError: await update.message.reply_text("❌ شخصی با این نام از قبل وجود دارد.")
+    except asyncpg.PostgresError: await update.message.reply_text("❌ خطایی در تغییر نام رخ داد.")
     return await edit_menu(update, context)
 
 async def change_choose_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -628,8 +888,7 @@ async def change_choose_account(update: Update, context: ContextTypes.DEFAULT_TY
     if not accounts:
         await update.message.reply_text("هیچ حسابی برای ویرایش وجود ندارد.")
         return await change_choose_target(update, context)
-    buttons = list(context.user_data['accounts_list'].keys())
-    keyboard = build_menu(buttons, 1, footer_buttons=[[BACK_BUTTON, HOME_BUTTON]])
+    keyboard = accounts_keyboard(context)
     await update.message.reply_text("کدام حساب را ویرایش می‌کنید؟", reply_markup=keyboard)
     return CHANGE_CHOOSE_ACCOUNT
 
@@ -640,9 +899,7 @@ async def change_choose_field(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ انتخاب نامعتبر. از دکمه‌ها استفاده کنید.")
         return CHANGE_CHOOSE_ACCOUNT
     context.user_data['change_account_id'] = account_id
-    buttons = list(FIELD_TO_COLUMN_MAP.keys())
-    keyboard = build_menu(buttons, 2, footer_buttons=[[BACK_BUTTON, HOME_BUTTON]])
-    await update.message.reply_text("کدام فیلد را تغییر می‌دهید؟", reply_markup=keyboard)
+    await update.message.reply_text("کدام فیلد را تغییر می‌دهید؟", reply_markup=CHANGE_FIELD_MARKUP)
     return CHANGE_CHOOSE_FIELD
 
 async def change_prompt_field_value(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -655,7 +912,7 @@ async def change_prompt_field_value(update: Update, context: ContextTypes.DEFAUL
     if field_name != "عکس کارت 🖼️":
         prompt = f"مقدار جدید را برای '{field_name}' وارد کنید:"
     
-    await update.message.reply_text(prompt, reply_markup=ReplyKeyboardMarkup([[SKIP_BUTTON], [BACK_BUTTON, HOME_BUTTON]], resize_keyboard=True))
+    await update.message.reply_text(prompt, reply_markup=SKIP_NAV_MARKUP)
     return CHANGE_PROMPT_FIELD_VALUE
 
 async def change_save_field_value(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -681,19 +938,15 @@ async def change_save_field_value(update: Update, context: ContextTypes.DEFAULT_
             await update.message.reply_text("لطفاً یک مقدار متنی وارد کنید، رد شوید یا بازگردید.")
             return CHANGE_PROMPT_FIELD_VALUE
 
-    conn = get_db_connection()
-    if not conn: return await edit_menu(update, context)
     try:
-        with conn.cursor() as cur:
-            # Using f-string for column name is generally unsafe, but here it's
-            # controlled by our internal FIELD_TO_COLUMN_MAP, so it's safe.
-            query = f"UPDATE accounts SET {column_name} = %s WHERE id = %s;"
-            cur.execute(query, (new_value, account_id))
-            conn.commit()
-            await update.message.reply_text(f"✅ فیلد '{field_name}' با موفقیت به‌روزرسانی شد.")
-    except psycopg2.Error as e:
+        # Using f-string for column name is generally unsafe, but here it's
+        # controlled by our internal FIELD_TO_COLUMN_MAP, so it's safe.
+        query = f"UPDATE accounts SET {column_name} = $1 WHERE id = $2 RETURNING person_id;"
+        person_id = await context.bot_data['pool'].fetchval(query, new_value, account_id)
+        invalidate_accounts(person_id)
+        await update.message.reply_text(f"✅ فیلد '{field_name}' با موفقیت به‌روزرسانی شد.")
+    except asyncpg.PostgresError as e:
         await update.message.reply_text(f"❌ خطایی در به‌روزرسانی فیلد رخ داد: {e}")
-    finally: conn.close()
     
     # Cleanup and return
     for key in ['change_person', 'change_account_id', 'change_field']:
@@ -707,81 +960,192 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data.clear()
     return await start(update, context)
 
+# Where the back button leads from each state
+BACK_ROUTES = {
+    ADMIN_ADD_USER: admin_menu,
+    ADMIN_REMOVE_USER: admin_menu,
+    ADMIN_IMPORT_ACCOUNTS: admin_menu,
+    VIEW_CHOOSE_ACCOUNT: view_choose_person,
+    ADD_CHOOSE_PERSON_TYPE: edit_menu,
+    DELETE_CHOOSE_TYPE: edit_menu,
+    CHANGE_CHOOSE_PERSON: edit_menu,
+    ADD_NEW_PERSON_NAME: add_choose_person_type,
+    ADD_CHOOSE_EXISTING_PERSON: add_choose_person_type,
+    DELETE_CHOOSE_PERSON: delete_choose_type,
+    DELETE_CHOOSE_ACCOUNT_FOR_PERSON: delete_choose_type,
+    DELETE_CHOOSE_ACCOUNT: delete_choose_account_for_person,
+    CHANGE_CHOOSE_TARGET: change_choose_person,
+    CHANGE_PROMPT_PERSON_NAME: change_choose_target,
+    CHANGE_CHOOSE_ACCOUNT: change_choose_target,
+    CHANGE_CHOOSE_FIELD: change_choose_account,
+    CHANGE_PROMPT_FIELD_VALUE: change_choose_field,
+    # A general back for add account flow
+    ADD_ACCOUNT_BANK: add_choose_person_type,
+    ADD_ACCOUNT_NUMBER: add_choose_person_type,
+    ADD_ACCOUNT_CARD: add_choose_person_type,
+    ADD_ACCOUNT_SHABA: add_choose_person_type,
+    ADD_ACCOUNT_PHOTO: add_choose_person_type,
+}
+
 # --- Main Application Setup ---
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates from different chats concurrently, but one at a time per chat.
+
+    ConversationHandler expects a user's updates in order, so only the
+    cross-chat work is parallelized. At most max_concurrent_updates handlers
+    run at once; updates still waiting for their own chat's turn don't count
+    toward that limit, so one busy chat can't starve the others.
+    """
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        # The base class takes its semaphore before the chat lock is awaited, so updates
+        # queued behind a busy chat would hold slots; it is left unbounded and the real
+        # limit is taken only once an update has its chat's lock
+        super().__init__(sys.maxsize)
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks = {}  # chat_id -> [lock, pending update count]
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._running:
+                await coroutine
+            return
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+async def post_init(application: Application) -> None:
+    """Creates the connection pool once and prepares the schema."""
+    pool = await create_db_pool()
+    application.bot_data['pool'] = pool
+    await setup_database(pool)
+
+async def post_shutdown(application: Application) -> None:
+    pool = application.bot_data.pop('pool', None)
+    if pool: await pool.close()
+
+def menu_handler(routes: dict) -> MessageHandler:
+    """Handles a menu state with one anchored regex over all its buttons and a dict dispatch."""
+    pattern = re.compile("^(?:" + "|".join(map(re.escape, routes)) + ")$")
+    async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        return await routes[update.message.text](update, context)
+    return MessageHandler(filters.Regex(pattern), dispatch)
+
+CONVERSATION_STATES = {
+    MAIN_MENU: [menu_handler({
+        "مشاهده اطلاعات 📄": view_choose_person,
+        "ویرایش ✏️": edit_menu,
+        "ادمین 🛠️": admin_menu,
+    })],
+    ADMIN_MENU: [menu_handler({
+        "مشاهده کاربران مجاز 👁️": admin_view_users,
+        "افزودن کاربر ➕": admin_prompt_add_user,
+        "حذف کاربر ➖": admin_prompt_remove_user,
+        "ورود حساب‌ها از فایل 📥": admin_prompt_import_accounts,
+    })],
+    ADMIN_ADD_USER: [MessageHandler(TEXT_INPUT, admin_add_user)],
+    ADMIN_REMOVE_USER: [MessageHandler(TEXT_INPUT, admin_remove_user)],
+    ADMIN_IMPORT_ACCOUNTS: [
+        MessageHandler(filters.Document.ALL, admin_import_accounts),
+        # Pasted text, photos, etc.: ask for the file again instead of falling through to start
+        MessageHandler(~filters.Document.ALL & ~filters.COMMAND & ~HOME_FILTER, admin_prompt_import_accounts),
+    ],
+    VIEW_CHOOSE_PERSON: [MessageHandler(TEXT_INPUT, view_choose_account)],
+    VIEW_CHOOSE_ACCOUNT: [MessageHandler(TEXT_INPUT, view_display_account_details)],
+    EDIT_MENU: [menu_handler({
+        "اضافه کردن ➕": add_choose_person_type,
+        "تغییر دادن 📝": change_choose_person,
+        "حذف کردن 🗑️": delete_choose_type,
+    })],
+    # Add Flow
+    ADD_CHOOSE_PERSON_TYPE: [menu_handler({"شخص جدید 👤": add_prompt_new_person_name, "شخص موجود 👥": add_choose_existing_person})],
+    ADD_NEW_PERSON_NAME: [MessageHandler(TEXT_INPUT, add_save_new_person_and_prompt_bank)],
+    ADD_CHOOSE_EXISTING_PERSON: [MessageHandler(TEXT_INPUT, add_set_existing_person_and_prompt_bank)],
+    ADD_ACCOUNT_BANK: [MessageHandler(TEXT_INPUT, add_account_get_bank)],
+    ADD_ACCOUNT_NUMBER: [MessageHandler(TEXT_INPUT, add_account_get_number)],
+    ADD_ACCOUNT_CARD: [MessageHandler(TEXT_INPUT, add_account_get_card)],
+    ADD_ACCOUNT_SHABA: [MessageHandler(TEXT_INPUT, add_account_get_shaba)],
+    ADD_ACCOUNT_PHOTO: [MessageHandler(filters.PHOTO | TEXT_INPUT, add_account_get_photo_and_save)],
+    # Delete Flow
+    DELETE_CHOOSE_TYPE: [menu_handler({"حذف شخص 👤": delete_choose_person, "حذف حساب 💳": delete_choose_account_for_person})],
+    DELETE_CHOOSE_PERSON: [MessageHandler(TEXT_INPUT, delete_confirm_person)],
+    DELETE_CONFIRM_PERSON: [MessageHandler(CONFIRM_DELETE_FILTER, delete_execute_person_deletion), MessageHandler(CANCEL_DELETE_FILTER, delete_cancel)],
+    DELETE_CHOOSE_ACCOUNT_FOR_PERSON: [MessageHandler(TEXT_INPUT, delete_choose_account)],
+    DELETE_CHOOSE_ACCOUNT: [MessageHandler(TEXT_INPUT, delete_confirm_account)],
+    DELETE_CONFIRM_ACCOUNT: [MessageHandler(CONFIRM_DELETE_FILTER, delete_execute_account_deletion), MessageHandler(CANCEL_DELETE_FILTER, delete_cancel)],
+    # Change Flow
+    CHANGE_CHOOSE_PERSON: [MessageHandler(TEXT_INPUT, change_choose_target)],
+    CHANGE_CHOOSE_TARGET: [menu_handler({"تغییر نام شخص 👤": change_prompt_person_name, "ویرایش یک حساب 💳": change_choose_account})],
+    CHANGE_PROMPT_PERSON_NAME: [MessageHandler(TEXT_INPUT, change_save_person_name)],
+    CHANGE_CHOOSE_ACCOUNT: [MessageHandler(TEXT_INPUT, change_choose_field)],
+    CHANGE_CHOOSE_FIELD: [MessageHandler(TEXT_INPUT, change_prompt_field_value)],
+    CHANGE_PROMPT_FIELD_VALUE: [MessageHandler(TEXT_INPUT | filters.PHOTO, change_save_field_value)],
+}
+# Each state checks its own back route first, before its input handlers
+CONVERSATION_STATES.update({
+    state: [MessageHandler(BACK_FILTER, back_handler), *CONVERSATION_STATES[state]]
+    for state, back_handler in BACK_ROUTES.items()
+})
+
+# Built once at import; main() only wires it into the application
+CONVERSATION_HANDLER = ConversationHandler(
+    entry_points=[CommandHandler("start", start)],
+    states=CONVERSATION_STATES,
+    fallbacks=[
+        CommandHandler("start", start),
+        MessageHandler(HOME_FILTER, main_menu),
+        CommandHandler("cancel", cancel),
+        MessageHandler(filters.ALL, start) # Catch-all
+    ],
+    per_message=False,
+)
+
 def main() -> None:
-    setup_database()
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-    
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
-        states={
-            MAIN_MENU: [
-                MessageHandler(filters.Regex("^مشاهده اطلاعات 📄$"), view_choose_person),
-                MessageHandler(filters.Regex("^ویرایش ✏️$"), edit_menu),
-                MessageHandler(filters.Regex("^ادمین 🛠️$"), admin_menu),
-            ],
-            ADMIN_MENU: [
-                MessageHandler(filters.Regex("^مشاهده کاربران مجاز 👁️$"), admin_view_users),
-                MessageHandler(filters.Regex("^افزودن کاربر ➕$"), admin_prompt_add_user),
-                MessageHandler(filters.Regex("^حذف کاربر ➖$"), admin_prompt_remove_user),
-            ],
-            ADMIN_ADD_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_user)],
-            ADMIN_REMOVE_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_remove_user)],
-            VIEW_CHOOSE_PERSON: [MessageHandler(filters.TEXT & ~filters.COMMAND, view_choose_account)],
-            VIEW_CHOOSE_ACCOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, view_display_account_details)],
-            EDIT_MENU: [
-                MessageHandler(filters.Regex("^اضافه کردن ➕$"), add_choose_person_type),
-                MessageHandler(filters.Regex("^تغییر دادن 📝$"), change_choose_person),
-                MessageHandler(filters.Regex("^حذف کردن 🗑️$"), delete_choose_type),
-            ],
-            # Add Flow
-            ADD_CHOOSE_PERSON_TYPE: [MessageHandler(filters.Regex("^شخص جدید 👤$"), add_prompt_new_person_name), MessageHandler(filters.Regex("^شخص موجود 👥$"), add_choose_existing_person)],
-            ADD_NEW_PERSON_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_save_new_person_and_prompt_bank)],
-            ADD_CHOOSE_EXISTING_PERSON: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_set_existing_person_and_prompt_bank)],
-            ADD_ACCOUNT_BANK: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_account_get_bank)],
-            ADD_ACCOUNT_NUMBER: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_account_get_number)],
-            ADD_ACCOUNT_CARD: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_account_get_card)],
-            ADD_ACCOUNT_SHABA: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_account_get_shaba)],
-            ADD_ACCOUNT_PHOTO: [MessageHandler(filters.PHOTO | filters.TEXT, add_account_get_photo_and_save)],
-            # Delete Flow
-            DELETE_CHOOSE_TYPE: [MessageHandler(filters.Regex("^حذف شخص 👤$"), delete_choose_person), MessageHandler(filters.Regex("^حذف حساب 💳$"), delete_choose_account_for_person)],
-            DELETE_CHOOSE_PERSON: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_confirm_person)],
-            DELETE_CONFIRM_PERSON: [MessageHandler(filters.Regex("^بله، حذف کن ✅$"), delete_execute_person_deletion), MessageHandler(filters.Regex("^نه، لغو کن ❌$"), delete_cancel)],
-            DELETE_CHOOSE_ACCOUNT_FOR_PERSON: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_choose_account)],
-            DELETE_CHOOSE_ACCOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_confirm_account)],
-            DELETE_CONFIRM_ACCOUNT: [MessageHandler(filters.Regex("^بله، حذف کن ✅$"), delete_execute_account_deletion), MessageHandler(filters.Regex("^نه، لغو کن ❌$"), delete_cancel)],
-            # Change Flow
-            CHANGE_CHOOSE_PERSON: [MessageHandler(filters.TEXT & ~filters.COMMAND, change_choose_target)],
-            CHANGE_CHOOSE_TARGET: [MessageHandler(filters.Regex("^تغییر نام شخص 👤$"), change_prompt_person_name), MessageHandler(filters.Regex("^ویرایش یک حساب 💳$"), change_choose_account)],
-            CHANGE_PROMPT_PERSON_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, change_save_person_name)],
-            CHANGE_CHOOSE_ACCOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, change_choose_field)],
-            CHANGE_CHOOSE_FIELD: [MessageHandler(filters.TEXT & ~filters.COMMAND, change_prompt_field_value)],
-            CHANGE_PROMPT_FIELD_VALUE: [MessageHandler(filters.TEXT | filters.PHOTO, change_save_field_value)],
-        },
-        fallbacks=[
-            CommandHandler("start", start),
-            MessageHandler(filters.Regex(f"^{HOME_BUTTON}$"), main_menu),
-            # Back Buttons
-            MessageHandler(filters.Regex(f"^{BACK_BUTTON}$") & (filters.State(ADMIN_ADD_USER) | filters.State(ADMIN_REMOVE_USER)), admin_menu),
-            MessageHandler(filters.Regex(f"^{BACK_BUTTON}$") & filters.State(VIEW_CHOOSE_ACCOUNT), view_choose_person),
-            MessageHandler(filters.Regex(f"^{BACK_BUTTON}$") & (filters.State(ADD_CHOOSE_PERSON_TYPE) | filters.State(DELETE_CHOOSE_TYPE) | filters.State(CHANGE_CHOOSE_PERSON)), edit_menu),
-            MessageHandler(filters.Regex(f"^{BACK_BUTTON}$") & (filters.State(ADD_NEW_PERSON_NAME) | filters.State(ADD_CHOOSE_EXISTING_PERSON)), add_choose_person_type),
-            MessageHandler(filters.Regex(f"^{BACK_BUTTON}$") & (filters.State(DELETE_CHOOSE_PERSON) | filters.State(DELETE_CHOOSE_ACCOUNT_FOR_PERSON)), delete_choose_type),
-            MessageHandler(filters.Regex(f"^{BACK_BUTTON}$") & filters.State(CHANGE_CHOOSE_TARGET), change_choose_person),
-            MessageHandler(filters.Regex(f"^{BACK_BUTTON}$") & filters.State(CHANGE_PROMPT_PERSON_NAME), change_choose_target),
-            MessageHandler(filters.Regex(f"^{BACK_BUTTON}$") & filters.State(CHANGE_CHOOSE_ACCOUNT), change_choose_target),
-            MessageHandler(filters.Regex(f"^{BACK_BUTTON}$") & filters.State(CHANGE_CHOOSE_FIELD), change_choose_account),
-            MessageHandler(filters.Regex(f"^{BACK_BUTTON}$") & filters.State(CHANGE_PROMPT_FIELD_VALUE), change_choose_field),
-            # A general back for add account flow
-            MessageHandler(filters.Regex(f"^{BACK_BUTTON}$") & (filters.State(ADD_ACCOUNT_BANK) | filters.State(ADD_ACCOUNT_NUMBER) | filters.State(ADD_ACCOUNT_CARD) | filters.State(ADD_ACCOUNT_SHABA) | filters.State(ADD_ACCOUNT_PHOTO)), add_choose_person_type),
-
-            CommandHandler("cancel", cancel),
-            MessageHandler(filters.ALL, start) # Catch-all
-        ],
-        per_message=False,
+    if uvloop:
+        # Must be installed before PTB creates its event loop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(256))
+        # One connection slot per concurrent update, multiplexed over HTTP/2
+        .connection_pool_size(256)
+        .pool_timeout(5.0)
+        .http_version("2")
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
     )
-    application.add_handler(conv_handler)
-    application.run_polling()
+    application.add_handler(CONVERSATION_HANDLER)
+    # Only plain messages drive the conversation
+    if WEBHOOK_URL:
+        # Telegram pushes each update as it happens, so there is no polling round-trip at all
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=[Update.MESSAGE],
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        # Long-poll so an idle bot makes few requests
+        application.run_polling(allowed_updates=[Update.MESSAGE], timeout=30)
 
 if __name__ == "__main__":
     main()